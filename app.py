@@ -4,14 +4,23 @@ Flask API for Video Generator
 """
 
 import os
+import hashlib
+import json
+import shutil
+import time
 import uuid
 import logging
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from itertools import islice
 from pathlib import Path
-from threading import Lock
+from threading import Lock, Thread
+from typing import Optional
 from concurrent.futures import ThreadPoolExecutor
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 from config import config
 from video_generator import VideoGenerator
@@ -34,50 +43,203 @@ Config = app.config
 # Configure CORS
 CORS(app, origins=Config['CORS_ORIGINS'])
 
-# Thread pool for video generation
+# Thread pool for video generation - workers mostly wait on the ffmpeg
+# subprocess, so threads are enough; CPU is split via FFMPEG_THREADS_PER_JOB
 executor = ThreadPoolExecutor(max_workers=Config['MAX_CONCURRENT_VIDEOS'])
 
-# Job tracking
-job_status = {}
-job_lock = Lock()
+
+TERMINAL_STATUSES = {'completed', 'failed'}
+
+
+@dataclass
+class JobState:
+    """
+    Per-job status record
+
+    Single attribute reads/writes are atomic under the GIL, so pollers read
+    fields directly. Only lifecycle transitions take the per-job lock.
+    """
+    status: str = 'queued'
+    progress: int = 0
+    created_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
+    completed_at: Optional[str] = None
+    video_url: Optional[str] = None
+    output_path: Optional[str] = None
+    error: Optional[str] = None
+    finished_at: Optional[float] = field(default=None, repr=False)
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    @property
+    def is_terminal(self) -> bool:
+        return self.status in TERMINAL_STATUSES
+
+    def to_dict(self) -> dict:
+        """Snapshot of the public fields for JSON responses"""
+        return {
+            'status': self.status,
+            'progress': self.progress,
+            'created_at': self.created_at,
+            'completed_at': self.completed_at,
+            'video_url': self.video_url,
+            'output_path': self.output_path,
+            'error': self.error
+        }
+
+
+# Upload streaming chunk size
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Job tracking - sharded by job_id so inserts only contend within a shard.
+# Shard locks guard mutation; lookups are lock-free dict reads. Each shard
+# is kept in insertion order and its oldest finished jobs are evicted
+# first (FIFO) once it exceeds its share of MAX_TRACKED_JOBS.
+_N_SHARDS = 16
+_shards = [(OrderedDict(), Lock()) for _ in range(_N_SHARDS)]
+_SHARD_CAPACITY = max(1, -(-Config['MAX_TRACKED_JOBS'] // _N_SHARDS))
+
+# Idempotency key (Idempotency-Key header or request hash) ->
+# (request fingerprint, job_id)
+idempotency_map = {}
+idempotency_lock = Lock()
 
 
 # ======================= Helper Functions =======================
 
+def _shard(job_id: str) -> tuple:
+    """Get the (jobs, lock) shard that owns a job_id"""
+    return _shards[hash(job_id) & (_N_SHARDS - 1)]
+
+
+def get_job(job_id: str) -> Optional[JobState]:
+    """Look up a job's state without locking"""
+    jobs, _ = _shard(job_id)
+    return jobs.get(job_id)
+
+
+def add_job(job_id: str, state: JobState):
+    """
+    Register a new job, evicting the shard's oldest finished jobs when full
+    
+    Queued and processing jobs are never evicted, so a shard can run over
+    capacity while all its jobs are still in flight.
+    """
+    jobs, lock = _shard(job_id)
+    with lock:
+        jobs[job_id] = state
+        excess = len(jobs) - _SHARD_CAPACITY
+        if excess > 0:
+            evictable = list(islice(
+                (old_id for old_id, old in jobs.items() if old.is_terminal), excess
+            ))
+            for old_id in evictable:
+                del jobs[old_id]
+            if len(jobs) > _SHARD_CAPACITY:
+                logger.warning(f"Job shard over capacity with {len(jobs)} unfinished jobs")
+
+
+def request_fingerprint(data: dict) -> str:
+    """Hash the parameters of a generate request into an idempotency key"""
+    canonical = json.dumps({
+        'upload_id': data.get('upload_id'),
+        'text_overlays': data.get('text_overlays'),
+        'music_file': data.get('music_file'),
+        'duration_per_image': data.get('duration_per_image', 3.0),
+        'transition_duration': data.get('transition_duration', 0.5),
+        'output_quality': data.get('output_quality', 'high')
+    }, sort_keys=True)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def evict_expired_jobs():
+    """Drop finished jobs older than the output retention period"""
+    cutoff = time.time() - Config['OUTPUT_RETENTION_HOURS'] * 3600
+    evicted = 0
+    for jobs, lock in _shards:
+        with lock:
+            expired = [
+                job_id for job_id, state in jobs.items()
+                if state.is_terminal and state.finished_at is not None and state.finished_at < cutoff
+            ]
+            for job_id in expired:
+                del jobs[job_id]
+        evicted += len(expired)
+    
+    if evicted:
+        logger.info(f"Evicted {evicted} expired jobs")
+    
+    # Forget idempotency keys whose job is no longer tracked
+    with idempotency_lock:
+        stale = [key for key, (_, job_id) in idempotency_map.items() if get_job(job_id) is None]
+        for key in stale:
+            del idempotency_map[key]
+
+
+def _job_eviction_loop():
+    """Background loop running evict_expired_jobs"""
+    while True:
+        time.sleep(Config['JOB_EVICTION_INTERVAL_SECONDS'])
+        try:
+            evict_expired_jobs()
+        except Exception as e:
+            logger.error(f"Error evicting expired jobs: {str(e)}")
+
+
 def allowed_file(filename: str, allowed_extensions: set) -> bool:
     """Check if file extension is allowed"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 
+def save_upload_stream(stream, file_path: Path, max_bytes: int) -> int:
+    """
+    Stream an uploaded file to disk in large chunks
+
+    Stops as soon as more than max_bytes have been written.
+    
+    Returns:
+        Number of bytes written (max_bytes + chunk overshoot if cut off)
+    """
+    written = 0
+    with open(file_path, 'wb', buffering=UPLOAD_CHUNK_SIZE) as out:
+        while True:
+            chunk = stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+            written += len(chunk)
+            if written > max_bytes:
+                break
+    return written
+
+
 def cleanup_old_files():
     """Remove old uploaded and generated files"""
     try:
-        now = datetime.utcnow()
+        now = time.time()
         
         # Cleanup uploads
-        upload_cutoff = now - timedelta(hours=Config['UPLOAD_RETENTION_HOURS'])
-        for upload_dir in Config['UPLOAD_FOLDER'].iterdir():
-            if upload_dir.is_dir():
-                dir_time = datetime.fromtimestamp(upload_dir.stat().st_mtime)
-                if dir_time < upload_cutoff:
-                    import shutil
-                    shutil.rmtree(upload_dir)
-                    logger.info(f"Cleaned up old upload: {upload_dir}")
+        upload_cutoff = now - Config['UPLOAD_RETENTION_HOURS'] * 3600
+        with os.scandir(Config['UPLOAD_FOLDER']) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False) and entry.stat().st_mtime < upload_cutoff:
+                    shutil.rmtree(entry.path)
+                    logger.info(f"Cleaned up old upload: {entry.path}")
         
         # Cleanup outputs
-        output_cutoff = now - timedelta(hours=Config['OUTPUT_RETENTION_HOURS'])
-        for output_file in Config['OUTPUT_FOLDER'].iterdir():
-            if output_file.is_file():
-                file_time = datetime.fromtimestamp(output_file.stat().st_mtime)
-                if file_time < output_cutoff:
-                    output_file.unlink()
-                    logger.info(f"Cleaned up old output: {output_file}")
+        output_cutoff = now - Config['OUTPUT_RETENTION_HOURS'] * 3600
+        with os.scandir(Config['OUTPUT_FOLDER']) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < output_cutoff:
+                    os.unlink(entry.path)
+                    logger.info(f"Cleaned up old output: {entry.path}")
                     
     except Exception as e:
         logger.error(f"Error during cleanup: {str(e)}")
 
 
+Thread(target=_job_eviction_loop, name='job-eviction', daemon=True).start()
+
+
 # ======================= API Endpoints =======================
 
 @app.route('/api/health', methods=['GET'])
@@ -157,38 +319,40 @@ def upload_images():
         # Save uploaded files
         saved_files = []
         total_size = 0
+        max_file_bytes = Config['MAX_FILE_SIZE_MB'] * 1024 * 1024
+        max_total_bytes = Config['MAX_TOTAL_SIZE_MB'] * 1024 * 1024
         
         for file in files:
             if file and allowed_file(file.filename, Config['ALLOWED_IMAGE_EXTENSIONS']):
                 filename = secure_filename(file.filename)
                 file_path = upload_dir / filename
-                file.save(str(file_path))
                 
-                file_size = file_path.stat().st_size
+                # Never write more than the remaining total budget allows
+                limit = min(max_file_bytes, max_total_bytes - total_size)
+                file_size = save_upload_stream(file.stream, file_path, limit)
                 total_size += file_size
                 
                 # Check individual file size
-                if file_size > Config['MAX_FILE_SIZE_MB'] * 1024 * 1024:
+                if file_size > max_file_bytes:
+                    shutil.rmtree(upload_dir)
                     return jsonify({
                         'success': False,
                         'error': f'File {filename} exceeds {Config["MAX_FILE_SIZE_MB"]}MB limit'
                     }), 400
                 
+                # Check total size
+                if total_size > max_total_bytes:
+                    shutil.rmtree(upload_dir)
+                    return jsonify({
+                        'success': False,
+                        'error': f'Total upload size exceeds {Config["MAX_TOTAL_SIZE_MB"]}MB limit'
+                    }), 400
+                
                 saved_files.append({
                     'filename': filename,
                     'size': file_size
                 })
         
-        # Check total size
-        if total_size > Config['MAX_TOTAL_SIZE_MB'] * 1024 * 1024:
-            # Cleanup
-            import shutil
-            shutil.rmtree(upload_dir)
-            return jsonify({
-                'success': False,
-                'error': f'Total upload size exceeds {Config["MAX_TOTAL_SIZE_MB"]}MB limit'
-            }), 400
-        
         logger.info(f"Upload complete: {upload_id} - {len(saved_files)} files")
         
         return jsonify({
@@ -199,6 +363,9 @@ def upload_images():
             'files': saved_files
         }), 200
         
+    except HTTPException:
+        # Let Flask's handlers answer e.g. 413 from MAX_CONTENT_LENGTH
+        raise
     except Exception as e:
         logger.error(f"Error uploading images: {str(e)}")
         return jsonify({
@@ -218,13 +385,24 @@ def generate_video():
         
         # Validate required fields
         required_fields = ['upload_id', 'text_overlays']
-        for field in required_fields:
-            if field not in data:
+        for field_name in required_fields:
+            if field_name not in data:
                 return jsonify({
                     'success': False,
-                    'error': f'Missing required field: {field}'
+                    'error': f'Missing required field: {field_name}'
                 }), 400
         
+        # null is accepted as "no overlays"
+        overlays = data['text_overlays'] or []
+        if not isinstance(overlays, list) or not all(
+            isinstance(overlay, dict) and 'text' in overlay
+            for overlay in overlays
+        ):
+            return jsonify({
+                'success': False,
+                'error': "text_overlays must be a list of objects with a 'text' field"
+            }), 400
+        
         upload_id = data['upload_id']
         text_overlays = data['text_overlays']
         music_file = data.get('music_file', None)
@@ -249,22 +427,50 @@ def generate_video():
                     'error': 'Invalid music file'
                 }), 400
         
-        # Create job ID
-        job_id = str(uuid.uuid4())
+        # Retried requests map to the job they already started
+        fingerprint = request_fingerprint(data)
+        idempotency_key = request.headers.get('Idempotency-Key') or fingerprint
         
-        with job_lock:
-            job_status[job_id] = {
-                'status': 'queued',
-                'progress': 0,
-                'created_at': datetime.utcnow().isoformat(),
-                'video_url': None,
-                'error': None
-            }
+        with idempotency_lock:
+            existing_fingerprint, existing_id = idempotency_map.get(idempotency_key, (None, None))
+            existing = get_job(existing_id) if existing_id else None
+            
+            if existing is not None and existing_fingerprint != fingerprint:
+                return jsonify({
+                    'success': False,
+                    'error': 'Idempotency-Key was already used with a different request'
+                }), 422
+            
+            if existing is None or existing.status == 'failed':
+                # A new key for an identical body joins the job still
+                # rendering it, so two encoders never write the same file
+                _, body_id = idempotency_map.get(fingerprint, (None, None))
+                body_job = get_job(body_id) if body_id else None
+                if body_job is not None and not body_job.is_terminal:
+                    existing_id, existing = body_id, body_job
+                    idempotency_map[idempotency_key] = (fingerprint, body_id)
+            
+            if existing is not None and existing.status != 'failed':
+                return jsonify({
+                    'success': True,
+                    'job_id': existing_id,
+                    'message': 'Video generation already started',
+                    'status_url': f'/api/video/status/{existing_id}'
+                }), 202
+            
+            # Create job ID
+            job_id = str(uuid.uuid4())
+            
+            state = JobState()
+            add_job(job_id, state)
+            idempotency_map[idempotency_key] = (fingerprint, job_id)
+            idempotency_map[fingerprint] = (fingerprint, job_id)
         
         # Submit job to thread pool
         executor.submit(
             process_video_generation,
             job_id,
+            state,
             str(upload_dir),
             text_overlays,
             music_file,
@@ -290,6 +496,7 @@ def generate_video():
 
 def process_video_generation(
     job_id, 
+    state, 
     upload_dir, 
     text_overlays, 
     music_file, 
@@ -300,21 +507,21 @@ def process_video_generation(
     """Background task for video generation"""
     try:
         # Update status to processing
-        with job_lock:
-            job_status[job_id]['status'] = 'processing'
-            job_status[job_id]['progress'] = 10
+        with state.lock:
+            state.status = 'processing'
+            state.progress = 10
         
         # Initialize video generator
         generator = VideoGenerator(
             upload_dir=upload_dir,
             output_dir=str(Config['OUTPUT_FOLDER']),
-            music_library_path=str(Config['MUSIC_LIBRARY_PATH'])
+            music_library_path=str(Config['MUSIC_LIBRARY_PATH']),
+            threads=Config['FFMPEG_THREADS_PER_JOB']
         )
         
         # Progress callback
         def update_progress(progress):
-            with job_lock:
-                job_status[job_id]['progress'] = progress
+            state.progress = progress
         
         # Generate video
         output_path = generator.generate_video(
@@ -326,76 +533,62 @@ def process_video_generation(
             progress_callback=update_progress
         )
         
-        # Update status to completed
-        with job_lock:
-            job_status[job_id]['status'] = 'completed'
-            job_status[job_id]['progress'] = 100
-            job_status[job_id]['video_url'] = f'/api/video/download/{job_id}'
-            job_status[job_id]['output_path'] = output_path
-            job_status[job_id]['completed_at'] = datetime.utcnow().isoformat()
+        # Update status to completed - status is written last so lock-free
+        # readers never see 'completed' without an output path
+        with state.lock:
+            state.output_path = output_path
+            state.video_url = f'/api/video/download/{job_id}'
+            state.completed_at = datetime.utcnow().isoformat()
+            state.progress = 100
+            state.finished_at = time.time()
+            state.status = 'completed'
         
     except Exception as e:
         logger.error(f"Error processing video {job_id}: {str(e)}")
-        with job_lock:
-            job_status[job_id]['status'] = 'failed'
-            job_status[job_id]['error'] = str(e)
+        with state.lock:
+            state.error = str(e)
+            state.finished_at = time.time()
+            state.status = 'failed'
 
 
 @app.route('/api/video/status/<job_id>', methods=['GET'])
 def get_video_status(job_id):
     """Get status of video generation job"""
-    with job_lock:
-        if job_id not in job_status:
-            return jsonify({
-                'success': False,
-                'error': 'Job not found'
-            }), 404
-        
-        status = job_status[job_id].copy()
+    state = get_job(job_id)
+    if state is None:
+        return jsonify({
+            'success': False,
+            'error': 'Job not found'
+        }), 404
     
     return jsonify({
         'success': True,
         'job_id': job_id,
-        **status
+        **state.to_dict()
     }), 200
 
 
 @app.route('/api/video/download/<job_id>', methods=['GET'])
 def download_video(job_id):
     """Download generated video"""
-    # First check if job exists
-    with job_lock:
-        if job_id not in job_status:
-            # Job not in memory - try to find file directly
-            logger.warning(f"Job {job_id} not in status cache, searching for file")
-            import glob
-            pattern = os.path.join(Config['OUTPUT_FOLDER'], f'video_*{job_id[:8]}*.mp4')
-            files = glob.glob(pattern)
-            if files:
-                output_path = files[0]
-                logger.info(f"Found video file: {output_path}")
-            else:
-                # Try any recent video file
-                files = sorted(glob.glob(os.path.join(Config['OUTPUT_FOLDER'], 'video_*.mp4')), 
-                             key=os.path.getmtime, reverse=True)
-                if files:
-                    output_path = files[0]
-                    logger.info(f"Returning most recent video: {output_path}")
-                else:
-                    return jsonify({
-                        'success': False,
-                        'error': 'Video file not found. It may have expired.'
-                    }), 404
-        else:
-            status = job_status[job_id]
-            
-            if status['status'] != 'completed':
-                return jsonify({
-                    'success': False,
-                    'error': f"Video not ready. Current status: {status['status']}"
-                }), 400
-            
-            output_path = status.get('output_path')
+    state = get_job(job_id)
+    if state is None:
+        # Untracked or evicted jobs are not looked up on disk; output files
+        # are named by upload, so nothing ties them back to this job_id
+        return jsonify({
+            'success': False,
+            'error': 'Video not found. It may have expired.'
+        }), 404
+    
+    status = state.status
+    
+    if status != 'completed':
+        return jsonify({
+            'success': False,
+            'error': f"Video not ready. Current status: {status}"
+        }), 400
+    
+    output_path = state.output_path
     
     if not output_path or not os.path.exists(output_path):
         return jsonify({
@@ -403,12 +596,24 @@ def download_video(job_id):
             'error': 'Video file not found on disk'
         }), 404
     
+    filename = os.path.basename(output_path)
+    
+    if Config['USE_X_ACCEL_REDIRECT']:
+        # Hand the transfer to nginx, which serves the file from an internal location
+        internal_path = Config['X_ACCEL_REDIRECT_PREFIX'].rstrip('/') + '/' + filename
+        logger.info(f"Redirecting video download to nginx: {internal_path}")
+        return Response(headers={
+            'X-Accel-Redirect': internal_path,
+            'Content-Type': 'video/mp4',
+            'Content-Disposition': f'attachment; filename="{filename}"'
+        })
+    
     logger.info(f"Serving video file: {output_path}")
     return send_file(
         output_path,
         mimetype='video/mp4',
         as_attachment=True,
-        download_name=os.path.basename(output_path)
+        download_name=filename
     )
 
 # ======================= Error Handlers =======================
@@ -421,6 +626,14 @@ def not_found(error):
     }), 404
 
 
+@app.errorhandler(413)
+def request_too_large(error):
+    return jsonify({
+        'success': False,
+        'error': f'Total upload size exceeds {Config["MAX_TOTAL_SIZE_MB"]}MB limit'
+    }), 413
+
+
 @app.errorhandler(500)
 def internal_error(error):
     logger.error(f"Internal server error: {str(error)}")
@@ -37,8 +37,26 @@ class Config:
     ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'bmp'}
     ALLOWED_AUDIO_EXTENSIONS = {'mp3', 'wav', 'm4a'}
     
+    # Reject oversize request bodies before they are read (1MB multipart headroom)
+    MAX_CONTENT_LENGTH = (MAX_TOTAL_SIZE_MB + 1) * 1024 * 1024
+    
     # Video generation settings
     MAX_CONCURRENT_VIDEOS = int(os.getenv('MAX_CONCURRENT_VIDEOS', 3))
+    # Split encoder threads between concurrent jobs instead of each job assuming all cores
+    FFMPEG_THREADS_PER_JOB = int(os.getenv(
+        'FFMPEG_THREADS_PER_JOB',
+        max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_VIDEOS)
+    ))
+    
+    # Job tracking - status is kept in memory for at most this many jobs;
+    # finished jobs are also dropped after OUTPUT_RETENTION_HOURS
+    MAX_TRACKED_JOBS = int(os.getenv('MAX_TRACKED_JOBS', 10000))
+    JOB_EVICTION_INTERVAL_SECONDS = 300
+    
+    # Video downloads - when enabled nginx serves OUTPUT_FOLDER from the
+    # internal location X_ACCEL_REDIRECT_PREFIX instead of Flask
+    USE_X_ACCEL_REDIRECT = os.getenv('USE_X_ACCEL_REDIRECT', 'false').lower() == 'true'
+    X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '/protected/outputs/')
     
     # File retention (in hours)
     UPLOAD_RETENTION_HOURS = int(os.getenv('UPLOAD_RETENTION_HOURS', 24))
@@ -58,14 +76,14 @@ class Config:
             'bitrate': '1500k',
             'audio_bitrate': '128k',
             'fps': 30,
-            'preset': 'medium'
+            'preset': 'faster'
         },
         'high': {
             'resolution': (1920, 1080),
-            'bitrate': '3000k',
+            'crf': 20,
             'audio_bitrate': '192k',
             'fps': 30,
-            'preset': 'slow'
+            'preset': 'veryfast'
         }
     }
     
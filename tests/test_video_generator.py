@@ -0,0 +1,63 @@
+"""
+Smoke tests for the video generation engine
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+from PIL import Image
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# Runs in a fresh interpreter so the preprocessing pool is created cold,
+# after ffmpeg's stdin pipe is already open
+GENERATE_SCRIPT = """
+import sys
+from video_generator import VideoGenerator
+
+generator = VideoGenerator(sys.argv[1], sys.argv[2], sys.argv[2], threads=1)
+print(generator.generate_video(
+    text_overlays=[{'text': 'Hello'}, {'text': 'Second', 'image_index': 1}],
+    duration_per_image=1.0,
+    transition_duration=0.25,
+    output_quality='low'
+))
+"""
+
+
+@unittest.skipIf(shutil.which(FFMPEG_BINARY) is None, 'ffmpeg not available')
+class GenerateVideoSmokeTest(unittest.TestCase):
+
+    def test_two_image_video_in_fresh_process(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            upload_dir = Path(tmp) / 'upload'
+            output_dir = Path(tmp) / 'output'
+            upload_dir.mkdir()
+            output_dir.mkdir()
+
+            for idx, color in enumerate(['red', 'blue']):
+                Image.new('RGB', (640, 480), color).save(upload_dir / f'image_{idx}.jpg')
+
+            result = subprocess.run(
+                [sys.executable, '-c', GENERATE_SCRIPT, str(upload_dir), str(output_dir)],
+                cwd=REPO_ROOT,
+                capture_output=True,
+                text=True,
+                timeout=60
+            )
+
+            self.assertEqual(result.returncode, 0, result.stderr)
+            output_path = result.stdout.strip().splitlines()[-1]
+            self.assertTrue(os.path.getsize(output_path) > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
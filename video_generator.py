@@ -1,23 +1,237 @@
 # video_generator.py
 """
-Core video generation engine using MoviePy
+Core video generation engine using FFmpeg
 """
 
 import os
 import logging
-from typing import List, Dict, Callable, Optional
-from moviepy.editor import (
-    ImageClip, 
-    concatenate_videoclips, 
-    CompositeVideoClip,
-    AudioFileClip
-)
-from moviepy.video.fx.fadein import fadein
-from moviepy.video.fx.fadeout import fadeout
+import multiprocessing
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from fractions import Fraction
+from functools import lru_cache
+from threading import Lock
+from typing import List, Dict, Callable, Optional, Tuple
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 logger = logging.getLogger(__name__)
 
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY', 'ffmpeg')
+
+# Hardware H.264 encoders in order of preference, libx264 is the fallback
+HARDWARE_ENCODERS = ['h264_nvenc', 'h264_qsv', 'h264_vaapi', 'h264_videotoolbox']
+SOFTWARE_ENCODER = 'libx264'
+VAAPI_DEVICE = os.getenv('VAAPI_DEVICE', '/dev/dri/renderD128')
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp'}
+
+# Output frame geometry
+FRAME_SIZE = (1280, 720)
+FPS = 30
+
+FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+# Distinct font sizes kept parsed; font_size comes from the client
+FONT_CACHE_SIZE = 32
+
+COLOR_MAP = {
+    'white': (255, 255, 255),
+    'black': (0, 0, 0),
+    'red': (255, 0, 0),
+    'blue': (0, 0, 255),
+    'yellow': (255, 255, 0),
+    'green': (0, 255, 0)
+}
+
+# Marks an overlay without an image_index, which is shown on every image
+_ALL_IMAGES = object()
+
+# Image preprocessing pool shared by all jobs in this process
+_preprocess_pool = None
+_preprocess_pool_lock = Lock()
+
+
+def _get_preprocess_pool() -> ProcessPoolExecutor:
+    """
+    Get the shared preprocessing pool, starting it on first use
+    
+    Worker processes are started once and reused, so jobs do not each
+    pay for forking a pool. They come from a forkserver rather than a
+    fork of this process, so they never inherit another job's ffmpeg
+    stdin pipe and hold it open past stdin.close().
+    """
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is None:
+            _preprocess_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context('forkserver')
+            )
+        return _preprocess_pool
+
+
+def _reset_preprocess_pool(broken_pool: ProcessPoolExecutor):
+    """
+    Discard a broken preprocessing pool so the next job starts a new one
+    
+    Only the pool that broke is dropped; if another job has already
+    replaced it, the new pool is left running.
+    """
+    global _preprocess_pool
+    with _preprocess_pool_lock:
+        if _preprocess_pool is broken_pool:
+            _preprocess_pool = None
+    broken_pool.shutdown(wait=False)
+
+
+def _encoder_args(codec: str) -> tuple:
+    """
+    FFmpeg arguments needed to feed software frames to an encoder
+    
+    Returns:
+        (global args, filter graph output format chain)
+    """
+    if codec == 'h264_vaapi':
+        return ['-vaapi_device', VAAPI_DEVICE], 'format=nv12,hwupload'
+    if codec == 'h264_qsv':
+        return [], 'format=nv12'
+    return [], 'format=yuv420p'
+
+
+def _encoder_works(codec: str) -> bool:
+    """Check an encoder can open by encoding a few blank frames"""
+    global_args, output_format = _encoder_args(codec)
+    cmd = [
+        FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', *global_args,
+        '-f', 'lavfi', '-i', 'color=black:s=256x256:d=0.1',
+        '-vf', output_format, '-c:v', codec, '-f', 'null', '-'
+    ]
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=15)
+        return result.returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+@lru_cache(maxsize=None)
+def detect_video_codec() -> str:
+    """
+    Pick the fastest working H.264 encoder, probed once per process
+    
+    Set FORCE_SW_ENCODE=1 to always use libx264.
+    """
+    if os.getenv('FORCE_SW_ENCODE', '0') == '1':
+        return SOFTWARE_ENCODER
+    
+    try:
+        result = subprocess.run(
+            [FFMPEG_BINARY, '-hide_banner', '-encoders'],
+            capture_output=True, text=True, timeout=15
+        )
+        available = result.stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logger.warning(f"Could not list ffmpeg encoders: {str(e)}")
+        return SOFTWARE_ENCODER
+    
+    # An encoder can be compiled in without the hardware being present
+    for codec in HARDWARE_ENCODERS:
+        if f' {codec} ' in available and _encoder_works(codec):
+            logger.info(f"Using hardware video encoder: {codec}")
+            return codec
+    
+    return SOFTWARE_ENCODER
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _get_font(size: int):
+    """
+    Get a parsed font for the given size, shared across requests
+    
+    Loads DejaVu, falling back to PIL's default font. Fonts are kept in
+    a bounded LRU cache, so requests cycling through many sizes re-parse
+    rather than grow memory.
+    """
+    try:
+        return ImageFont.truetype(FONT_PATH, size)
+    except:
+        try:
+            return ImageFont.load_default()
+        except:
+            return None
+
+
+# Preload the default overlay size at import
+_get_font(50)
+
+
+@lru_cache(maxsize=128)
+def _render_text_overlay(
+    text: str,
+    position: str = 'center',
+    font_size: int = 50,
+    color: str = 'white'
+) -> Tuple[np.ndarray, Tuple[int, int]]:
+    """
+    Render text onto a transparent canvas cropped to the text
+    
+    Results are cached and shared between callers, so the returned
+    array is read-only.
+    
+    Returns:
+        (RGBA image as HxWx4 uint8 array, (x, y) of its top-left corner in the frame)
+    """
+    img_width, img_height = FRAME_SIZE
+    font = _get_font(font_size)
+    stroke_width = 2 if font else 0
+    
+    # Measure on a throwaway 1x1 canvas
+    draw = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+    
+    # Get text size
+    if font:
+        bbox = draw.textbbox((0, 0), text, font=font)
+        ink_bbox = draw.textbbox((0, 0), text, font=font, stroke_width=stroke_width)
+    else:
+        bbox = ink_bbox = draw.textbbox((0, 0), text)
+    
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    
+    # Calculate position
+    position_map = {
+        'center': ((img_width - text_width) // 2, (img_height - text_height) // 2),
+        'top': ((img_width - text_width) // 2, 50),
+        'bottom': ((img_width - text_width) // 2, img_height - text_height - 50)
+    }
+    
+    text_position = position_map.get(position, position_map['center'])
+    
+    # Create transparent image just large enough for the text and its stroke
+    img = Image.new(
+        'RGBA',
+        (max(1, ink_bbox[2] - ink_bbox[0]), max(1, ink_bbox[3] - ink_bbox[1])),
+        (0, 0, 0, 0)
+    )
+    draw = ImageDraw.Draw(img)
+    origin = (-ink_bbox[0], -ink_bbox[1])
+    
+    text_color = COLOR_MAP.get(color, (255, 255, 255))
+    
+    # Draw text with outline/stroke
+    stroke_color = (0, 0, 0) if color != 'black' else (255, 255, 255)
+    
+    if font:
+        draw.text(origin, text, font=font, fill=text_color, stroke_width=stroke_width, stroke_fill=stroke_color)
+    else:
+        draw.text(origin, text, fill=text_color)
+    
+    overlay = np.asarray(img)
+    overlay.setflags(write=False)
+    return overlay, (text_position[0] + ink_bbox[0], text_position[1] + ink_bbox[1])
+
 
 class VideoGenerator:
     """
@@ -25,7 +239,13 @@ class VideoGenerator:
     Handles image processing, text overlays, audio, and video assembly
     """
     
-    def __init__(self, upload_dir: str, output_dir: str, music_library_path: str):
+    def __init__(
+        self,
+        upload_dir: str,
+        output_dir: str,
+        music_library_path: str,
+        threads: int = 4
+    ):
         """
         Initialize Video Generator
         
@@ -33,14 +253,19 @@ class VideoGenerator:
             upload_dir: Directory containing uploaded images
             output_dir: Directory for output videos
             music_library_path: Path to music library
+            threads: FFmpeg encoder threads for this job
         """
         self.upload_dir = upload_dir
         self.output_dir = output_dir
         self.music_library_path = music_library_path
+        self.threads = threads
         
-        self.video_codec = 'libx264'
+        self.video_codec = detect_video_codec()
         self.audio_codec = 'aac'
         
+        # Overlay PNGs and positions for the current job, keyed by render params
+        self._overlay_paths = {}
+        
         self.quality_settings = {
             'low': {
                 'bitrate': '500k',
@@ -50,46 +275,43 @@ class VideoGenerator:
             'medium': {
                 'bitrate': '1500k',
                 'audio_bitrate': '128k',
-                'preset': 'medium'
+                'preset': 'faster'
             },
             'high': {
-                'bitrate': '3000k',
+                'crf': 20,
                 'audio_bitrate': '192k',
-                'preset': 'slow'
+                'preset': 'veryfast'
             }
         }
     
     def _get_image_files(self) -> List[str]:
         """Get all image files from upload directory"""
-        import glob
-        image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.bmp']
-        image_files = []
-        
-        for ext in image_extensions:
-            image_files.extend(glob.glob(os.path.join(self.upload_dir, ext)))
-            image_files.extend(glob.glob(os.path.join(self.upload_dir, ext.upper())))
-        
-        image_files.sort()
+        # One readdir pass; DirEntry.is_file() is answered from the dirent type
+        with os.scandir(self.upload_dir) as entries:
+            image_files = sorted(
+                entry.path for entry in entries
+                if entry.is_file(follow_symlinks=False)
+                and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS
+            )
         
         if not image_files:
             raise ValueError("No images found in upload directory")
         
         return image_files
     
-    def _resize_image(self, image_path: str, target_size: tuple = (1280, 720)) -> str:
+    def _resize_image(self, image_path: str, target_size: tuple = FRAME_SIZE) -> np.ndarray:
         """
-        Resize and optimize image for video
+        Resize and letterbox image into an in-memory video frame
         
         Args:
             image_path: Path to image
             target_size: Target resolution (width, height)
             
         Returns:
-            Path to processed image
+            Frame as HxWx3 uint8 array
         """
         try:
             img = Image.open(image_path)
-            img = img.convert('RGB')
             
             img_aspect = img.size[0] / img.size[1]
             target_aspect = target_size[0] / target_size[1]
@@ -101,18 +323,20 @@ class VideoGenerator:
                 new_height = target_size[1]
                 new_width = int(target_size[1] * img_aspect)
             
-            img = img.resize((new_width, new_height), Image.LANCZOS)
+            # JPEG only: decode at 1/2, 1/4 or 1/8 scale in the DCT domain
+            img.draft('RGB', (new_width, new_height))
+            img = img.convert('RGB')
+            # reducing_gap box-reduces large non-JPEG sources by an integer
+            # factor first, so BILINEAR only covers the last <2x step
+            img = img.resize((new_width, new_height), Image.BILINEAR, reducing_gap=2.0)
             
-            background = Image.new('RGB', target_size, (0, 0, 0))
+            frame = np.zeros((target_size[1], target_size[0], 3), dtype=np.uint8)
             
             paste_x = (target_size[0] - new_width) // 2
             paste_y = (target_size[1] - new_height) // 2
-            background.paste(img, (paste_x, paste_y))
+            frame[paste_y:paste_y + new_height, paste_x:paste_x + new_width] = np.asarray(img)
             
-            processed_path = image_path.replace('.', '_processed.')
-            background.save(processed_path, 'JPEG', quality=95)
-            
-            return processed_path
+            return frame
             
         except Exception as e:
             logger.error(f"Error processing image {image_path}: {str(e)}")
@@ -121,92 +345,210 @@ class VideoGenerator:
     def _create_text_overlay(
         self, 
         text: str, 
+        work_dir: str,
         position: str = 'center',
         font_size: int = 50,
-        color: str = 'white',
-        duration: float = 3.0
-    ) -> ImageClip:
+        color: str = 'white'
+    ) -> Tuple[str, Tuple[int, int]]:
         """
-        Create text overlay using PIL instead of TextClip
+        Create text overlay image for FFmpeg's overlay filter
         
         Args:
             text: Text to display
+            work_dir: Directory to write the overlay PNG into
             position: Position on screen ('top', 'center', 'bottom')
             font_size: Font size in pixels
             color: Text color
-            duration: Duration in seconds
             
         Returns:
-            ImageClip object with text
+            (path to RGBA PNG cropped to the text, (x, y) to place it at)
         """
         try:
-            import tempfile
-            
-            # Create transparent image for text
-            img_width, img_height = 1280, 720
-            img = Image.new('RGBA', (img_width, img_height), (0, 0, 0, 0))
-            draw = ImageDraw.Draw(img)
-            
-            # Try to use DejaVu font, fall back to default
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", font_size)
-            except:
-                try:
-                    font = ImageFont.load_default()
-                except:
-                    font = None
-            
-            # Get text size
-            if font:
-                bbox = draw.textbbox((0, 0), text, font=font)
-            else:
-                bbox = draw.textbbox((0, 0), text)
+            key = (text, position, font_size, color)
+            cached = self._overlay_paths.get(key)
+            if cached is None:
+                overlay, offset = _render_text_overlay(text, position, font_size, color)
+                overlay_path = os.path.join(work_dir, f"overlay_{len(self._overlay_paths)}.png")
+                Image.fromarray(overlay, 'RGBA').save(overlay_path, 'PNG', compress_level=1)
+                cached = self._overlay_paths[key] = (overlay_path, offset)
             
-            text_width = bbox[2] - bbox[0]
-            text_height = bbox[3] - bbox[1]
-            
-            # Calculate position
-            position_map = {
-                'center': ((img_width - text_width) // 2, (img_height - text_height) // 2),
-                'top': ((img_width - text_width) // 2, 50),
-                'bottom': ((img_width - text_width) // 2, img_height - text_height - 50)
-            }
-            
-            text_position = position_map.get(position, position_map['center'])
-            
-            # Color mapping
-            color_map = {
-                'white': (255, 255, 255),
-                'black': (0, 0, 0),
-                'red': (255, 0, 0),
-                'blue': (0, 0, 255),
-                'yellow': (255, 255, 0),
-                'green': (0, 255, 0)
-            }
+            return cached
             
-            text_color = color_map.get(color, (255, 255, 255))
+        except Exception as e:
+            logger.error(f"Error creating text overlay: {str(e)}")
+            raise
+    
+    def _index_text_overlays(
+        self,
+        text_overlays: List[Dict],
+        num_images: int
+    ) -> List[Tuple[Dict, Optional[List[int]]]]:
+        """
+        Group identical overlay configs across images
+        
+        Overlays with the same rendering parameters become one entry, so
+        each distinct overlay is a single FFmpeg input however many images
+        it is shown on.
+        
+        Args:
+            text_overlays: List of text overlay configurations
+            num_images: Number of images in the slideshow
             
-            # Draw text with outline/stroke
-            stroke_color = (0, 0, 0) if color != 'black' else (255, 255, 255)
+        Returns:
+            (overlay, image indices) pairs in first-appearance order, with
+            None as the indices of an overlay shown on every image
+        """
+        images_by_key = {}
+        first_overlay = {}
+        
+        for overlay in text_overlays:
+            key = (
+                overlay['text'],
+                overlay.get('position', 'center'),
+                overlay.get('font_size', 50),
+                overlay.get('color', 'white')
+            )
+            image_index = overlay.get('image_index', _ALL_IMAGES)
             
-            if font:
-                draw.text(text_position, text, font=font, fill=text_color, stroke_width=2, stroke_fill=stroke_color)
+            if image_index is _ALL_IMAGES:
+                images = None
+            elif image_index in range(num_images):
+                images = {int(image_index)}
             else:
-                draw.text(text_position, text, fill=text_color)
+                continue
             
-            # Save to temp file
-            temp_file = tempfile.NamedTemporaryFile(suffix='.png', delete=False)
-            img.save(temp_file.name, 'PNG')
-            temp_file.close()
-            
-            # Create ImageClip from the text image
-            text_clip = ImageClip(temp_file.name, duration=duration).set_position('center')
+            first_overlay.setdefault(key, overlay)
+            if key not in images_by_key:
+                images_by_key[key] = images
+            elif images is None or images_by_key[key] is None:
+                images_by_key[key] = None
+            else:
+                images_by_key[key] |= images
+        
+        return [
+            (first_overlay[key], None if images is None else sorted(images))
+            for key, images in images_by_key.items()
+        ]
+    
+    @staticmethod
+    def _enable_expression(image_indices: List[int], duration_per_image: float) -> str:
+        """
+        FFmpeg timeline expression that is true while any of the images is shown
+        
+        Runs of consecutive images are merged into a single time window.
+        """
+        windows = []
+        run_start = prev = image_indices[0]
+        for idx in image_indices[1:] + [None]:
+            if idx is not None and idx == prev + 1:
+                prev = idx
+                continue
+            start = run_start * duration_per_image
+            end = (prev + 1) * duration_per_image
+            windows.append(f"gte(t,{start:.3f})*lt(t,{end:.3f})")
+            if idx is not None:
+                run_start = prev = idx
+        
+        return '+'.join(windows)
+    
+    def _build_filter_graph(
+        self,
+        num_images: int,
+        overlays: List[tuple],
+        duration_per_image: float,
+        transition_duration: float,
+        output_format: str = 'format=yuv420p'
+    ) -> str:
+        """
+        Build the FFmpeg filter graph for the slideshow
+        
+        Input 0 carries one raw frame per image; each frame is held for
+        duration_per_image, faded in/out from black and then composited
+        with the overlay images (inputs 1..N) while any of their images
+        is shown.
+        
+        Args:
+            num_images: Number of frames on input 0
+            overlays: (image indices or None for all, input_index, x, y) tuples
+            duration_per_image: Duration each image is displayed
+            transition_duration: Duration of fade transitions
+            output_format: Filter chain converting to the encoder's input format
             
-            return text_clip
+        Returns:
+            filter_complex string with the result on [vout]
+        """
+        total_duration = num_images * duration_per_image
+        
+        # Clone the last frame so it is held for its full slot before trimming
+        base = [
+            f"tpad=stop_mode=clone:stop_duration={duration_per_image:.3f}",
+            f"fps={FPS}",
+            f"trim=duration={total_duration:.3f}"
+        ]
+        
+        if transition_duration > 0:
+            for idx in range(num_images):
+                start = idx * duration_per_image
+                end = start + duration_per_image
+                fade_out = end - transition_duration
+                base.append(
+                    f"fade=t=in:st={start:.3f}:d={transition_duration:.3f}"
+                    f":enable='gte(t,{start:.3f})*lt(t,{start + transition_duration:.3f})'"
+                )
+                base.append(
+                    f"fade=t=out:st={fade_out:.3f}:d={transition_duration:.3f}"
+                    f":enable='gte(t,{fade_out:.3f})*lt(t,{end:.3f})'"
+                )
+        
+        graph = [f"[0:v]{','.join(base)}[v0]"]
+        
+        for n, (image_indices, input_index, x, y) in enumerate(overlays, start=1):
+            enable = ''
+            if image_indices is not None:
+                enable = f":enable='{self._enable_expression(image_indices, duration_per_image)}'"
+            graph.append(f"[v{n - 1}][{input_index}:v]overlay=x={x}:y={y}{enable}[v{n}]")
+        
+        graph.append(f"[v{len(overlays)}]{output_format}[vout]")
+        
+        return ';'.join(graph)
+    
+    def _video_codec_args(self, quality: Dict) -> List[str]:
+        """
+        Map a quality preset onto arguments for the selected encoder
+        
+        Args:
+            quality: Entry from self.quality_settings, with either a
+                'bitrate' or a constant-quality 'crf' value
             
-        except Exception as e:
-            logger.error(f"Error creating text overlay: {str(e)}")
-            raise
+        Returns:
+            FFmpeg output arguments for the video stream
+        """
+        codec = self.video_codec
+        crf = quality.get('crf')
+        args = ['-c:v', codec]
+        
+        if codec == 'h264_nvenc':
+            args += ['-preset', 'p4', '-tune', 'hq', '-rc', 'vbr']
+        elif codec == 'h264_qsv':
+            args += ['-preset', 'medium']
+        elif codec == SOFTWARE_ENCODER:
+            args += ['-preset', quality['preset'], '-threads', str(self.threads)]
+        
+        if crf is None:
+            args += ['-b:v', quality['bitrate']]
+        elif codec == 'h264_nvenc':
+            args += ['-cq', str(crf), '-b:v', '0']
+        elif codec == 'h264_qsv':
+            args += ['-global_quality', str(crf)]
+        elif codec == 'h264_vaapi':
+            args += ['-rc_mode', 'CQP', '-qp', str(crf)]
+        elif codec == 'h264_videotoolbox':
+            # VideoToolbox quality is 1-100, higher is better
+            args += ['-q:v', str(max(1, 100 - 2 * crf))]
+        else:
+            args += ['-crf', str(crf)]
+        
+        return args
     
     def generate_video(
         self,
@@ -231,102 +573,126 @@ class VideoGenerator:
         Returns:
             Path to generated video file
         """
-        video_clips = []
         text_overlays = text_overlays or []
+        self._overlay_paths = {}
         
-        try:
+        with tempfile.TemporaryDirectory(prefix='overlays_') as work_dir:
             if progress_callback:
                 progress_callback(10)
             
             image_files = self._get_image_files()
-            logger.info(f"Found {len(image_files)} images to process")
-            
-            if progress_callback:
-                progress_callback(20)
-            
-            for idx, image_path in enumerate(image_files):
-                logger.info(f"Processing image {idx + 1}/{len(image_files)}")
-                
-                processed_image = self._resize_image(image_path)
-                
-                img_clip = ImageClip(processed_image, duration=duration_per_image)
-                
-                if transition_duration > 0:
-                    img_clip = fadein(img_clip, transition_duration)
-                    img_clip = fadeout(img_clip, transition_duration)
-                
-                clips_to_composite = [img_clip]
-                
-                for overlay in text_overlays:
-                    if overlay.get('image_index', idx) == idx:
-                        text_clip = self._create_text_overlay(
-                            text=overlay['text'],
-                            position=overlay.get('position', 'center'),
-                            font_size=overlay.get('font_size', 50),
-                            color=overlay.get('color', 'white'),
-                            duration=duration_per_image
-                        )
-                        clips_to_composite.append(text_clip)
-                
-                if len(clips_to_composite) > 1:
-                    composite_clip = CompositeVideoClip(clips_to_composite)
-                    video_clips.append(composite_clip)
-                else:
-                    video_clips.append(img_clip)
-                
-                if progress_callback:
-                    progress = 20 + int((idx + 1) / len(image_files) * 40)
-                    progress_callback(progress)
-            
-            logger.info("Concatenating video clips")
-            final_video = concatenate_videoclips(video_clips, method='compose')
-            
-            if progress_callback:
-                progress_callback(70)
-            
+            num_images = len(image_files)
+            logger.info(f"Found {num_images} images to process")
+            
+            width, height = FRAME_SIZE
+            frame_rate = 1 / Fraction(duration_per_image).limit_denominator(1000)
+            total_duration = num_images * duration_per_image
+            
+            global_args, output_format = _encoder_args(self.video_codec)
+            
+            cmd = [
+                FFMPEG_BINARY, '-hide_banner', '-loglevel', 'error', '-y', *global_args,
+                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}',
+                '-framerate', f'{frame_rate.numerator}/{frame_rate.denominator}',
+                '-i', 'pipe:0'
+            ]
+            
+            # One input per distinct overlay, stacked in request order
+            overlays = []
+            for overlay, image_indices in self._index_text_overlays(text_overlays, num_images):
+                overlay_path, (x, y) = self._create_text_overlay(
+                    text=overlay['text'],
+                    work_dir=work_dir,
+                    position=overlay.get('position', 'center'),
+                    font_size=overlay.get('font_size', 50),
+                    color=overlay.get('color', 'white')
+                )
+                cmd += ['-i', overlay_path]
+                overlays.append((image_indices, len(overlays) + 1, x, y))
+            
+            music_path = None
             if music_file:
                 music_path = os.path.join(self.music_library_path, music_file)
                 if os.path.exists(music_path):
                     logger.info(f"Adding background music: {music_file}")
-                    audio = AudioFileClip(music_path)
-                    
-                    if audio.duration < final_video.duration:
-                        num_loops = int(final_video.duration / audio.duration) + 1
-                        from moviepy.editor import concatenate_audioclips
-                        audio = concatenate_audioclips([audio] * num_loops)
-                    
-                    audio = audio.subclip(0, final_video.duration)
-                    final_video = final_video.set_audio(audio)
+                    # The demuxer rewinds on EOF, so short tracks loop without re-decoding
+                    cmd += ['-stream_loop', '-1', '-i', music_path]
+                else:
+                    music_path = None
             
-            if progress_callback:
-                progress_callback(80)
+            filter_graph = self._build_filter_graph(
+                num_images, overlays, duration_per_image, transition_duration, output_format
+            )
+            cmd += ['-filter_complex', filter_graph, '-map', '[vout]']
             
             output_filename = f"video_{os.path.basename(self.upload_dir)}.mp4"
             output_path = os.path.join(self.output_dir, output_filename)
             
             quality = self.quality_settings.get(output_quality, self.quality_settings['high'])
             
-            logger.info(f"Writing video to {output_path}")
-            final_video.write_videofile(
-                output_path,
-                fps=30,
-                codec=self.video_codec,
-                audio_codec=self.audio_codec,
-                bitrate=quality['bitrate'],
-                audio_bitrate=quality['audio_bitrate'],
-                preset=quality['preset'],
-                threads=4,
-                logger=None
-            )
+            cmd += self._video_codec_args(quality)
             
-            if progress_callback:
-                progress_callback(95)
+            if music_path:
+                cmd += [
+                    '-map', f'{len(overlays) + 1}:a',
+                    '-c:a', self.audio_codec,
+                    '-b:a', quality['audio_bitrate']
+                ]
             
-            self._cleanup_processed_images()
+            cmd += [
+                '-t', f'{total_duration:.3f}',
+                '-movflags', '+faststart',
+                output_path
+            ]
             
-            final_video.close()
-            for clip in video_clips:
-                clip.close()
+            if progress_callback:
+                progress_callback(20)
+            
+            logger.info(f"Writing video to {output_path}")
+            with tempfile.TemporaryFile() as stderr:
+                process = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.DEVNULL,
+                    stderr=stderr
+                )
+                
+                pool = _get_preprocess_pool()
+                try:
+                    # Decode/resize is CPU-bound and independent per image;
+                    # map() yields frames in input order
+                    frames = pool.map(self._resize_image, image_files, chunksize=4)
+                    
+                    for idx, frame in enumerate(frames):
+                        logger.info(f"Processing image {idx + 1}/{num_images}")
+                        process.stdin.write(frame.tobytes())
+                        
+                        if progress_callback:
+                            progress = 20 + int((idx + 1) / num_images * 40)
+                            progress_callback(progress)
+                    
+                    process.stdin.close()
+                except BrokenPipeError:
+                    # FFmpeg exited early; its stderr is reported below
+                    pass
+                except BrokenProcessPool:
+                    _reset_preprocess_pool(pool)
+                    process.kill()
+                    process.wait()
+                    raise
+                except Exception:
+                    process.kill()
+                    process.wait()
+                    raise
+                
+                if progress_callback:
+                    progress_callback(70)
+                
+                returncode = process.wait()
+                if returncode != 0:
+                    stderr.seek(0)
+                    error = stderr.read().decode('utf-8', errors='replace').strip()
+                    raise RuntimeError(f"ffmpeg exited with code {returncode}: {error[-1000:]}")
             
             if progress_callback:
                 progress_callback(100)
@@ -335,28 +701,6 @@ class VideoGenerator:
             
             file_size = os.path.getsize(output_path) / (1024 * 1024)
             logger.info(f"File size: {file_size:.2f} MB")
-            logger.info(f"Duration: {final_video.duration:.2f} seconds")
+            logger.info(f"Duration: {total_duration:.2f} seconds")
             
             return output_path
-            
-        except Exception as e:
-            logger.error(f"Error generating video: {str(e)}")
-            for clip in video_clips:
-                try:
-                    clip.close()
-                except:
-                    pass
-            raise
-    
-    def _cleanup_processed_images(self):
-        """Remove temporary processed images"""
-        try:
-            import glob
-            processed_images = glob.glob(os.path.join(self.upload_dir, '*_processed.*'))
-            for img in processed_images:
-                try:
-                    os.remove(img)
-                except:
-                    pass
-        except Exception as e:
-            logger.warning(f"Error cleaning up processed images: {str(e)}")